@@ -1,12 +1,29 @@
 import sqlite3
-from tinkoff.invest import Client, AccountType
+import threading
+from tinkoff.invest import AccountType
 import os
 
+from tinkoff_api import get_client
+
 DB_PATH = "account_state.db"
 TOKEN_INVEST = os.getenv("TINKOFF_TOKEN")
 
+_LOCK = threading.Lock()
+_conn: sqlite3.Connection | None = None
+_conn_pid: int | None = None
+
+def _connect() -> sqlite3.Connection:
+    # Одно соединение на процесс, WAL: читатели не ждут писателя.
+    global _conn, _conn_pid
+    if _conn is None or _conn_pid != os.getpid():
+        _conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+        _conn.execute("PRAGMA journal_mode=WAL")
+        _conn.execute("PRAGMA synchronous=NORMAL")
+        _conn_pid = os.getpid()
+    return _conn
+
 def init_account_db():
-    with sqlite3.connect(DB_PATH) as conn:
+    with _LOCK, _connect() as conn:
         conn.execute("""
         CREATE TABLE IF NOT EXISTS account_balance (
             id INTEGER PRIMARY KEY,
@@ -14,32 +31,59 @@ def init_account_db():
             updated_at TEXT DEFAULT CURRENT_TIMESTAMP
         )
         """)
+        _init_figi_cache(conn)
+
+def _init_figi_cache(conn: sqlite3.Connection):
+    # Ключ — FIGI: один тикер может торговаться в нескольких валютах.
+    # Старую таблицу с ключом по тикеру просто пересоздаём — это кэш.
+    pk = {row[1]: row[5] for row in conn.execute("PRAGMA table_info(figi_cache)")}
+    if pk.get("ticker"):
+        conn.execute("DROP TABLE figi_cache")
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS figi_cache (
+        figi TEXT PRIMARY KEY,
+        ticker TEXT,
+        currency TEXT,
+        cached_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+
+def load_figi_cache(ttl_sec: int) -> list[tuple[str, str, str]]:
+    """(ticker, figi, currency) из кэша, если он моложе ttl_sec; иначе пусто."""
+    with _LOCK, _connect() as conn:
+        _init_figi_cache(conn)
+        return conn.execute(
+            "SELECT ticker, figi, currency FROM figi_cache WHERE cached_at >= datetime('now', ?) ORDER BY rowid",
+            (f"-{ttl_sec} seconds",)
+        ).fetchall()
+
+def save_figi_cache(rows: list[tuple[str, str, str]]):
+    with _LOCK, _connect() as conn:
+        _init_figi_cache(conn)
+        conn.execute("DELETE FROM figi_cache")
+        conn.executemany("INSERT OR REPLACE INTO figi_cache (ticker, figi, currency) VALUES (?, ?, ?)", rows)
 
 def update_account_balance():
     capital = get_cash_rub()
-    with sqlite3.connect(DB_PATH) as conn:
+    with _LOCK, _connect() as conn:
         conn.execute("DELETE FROM account_balance")
         conn.execute("INSERT INTO account_balance (capital) VALUES (?)", (capital,))
     return capital
 
 def get_cash_rub() -> float:
-    token = os.getenv("TINKOFF_TOKEN")
-    if not token:
-        raise RuntimeError("TINKOFF_TOKEN not set")
-
-    with Client(token) as client:
-        accounts = client.users.get_accounts().accounts
-        acc = next(a for a in accounts if a.type == AccountType.ACCOUNT_TYPE_TINKOFF)
+    client = get_client()
+    accounts = client.users.get_accounts().accounts
+    acc = next(a for a in accounts if a.type == AccountType.ACCOUNT_TYPE_TINKOFF)
 
-        portfolio = client.operations.get_portfolio(account_id=acc.id)
-        for p in portfolio.positions:
-            if p.instrument_type == "currency" and p.figi == "BBG0013HGFT4":  # RUB
-                rub = p.quantity.units + p.quantity.nano / 1e9
-                return rub
+    portfolio = client.operations.get_portfolio(account_id=acc.id)
+    for p in portfolio.positions:
+        if p.instrument_type == "currency" and p.figi == "BBG0013HGFT4":  # RUB
+            rub = p.quantity.units + p.quantity.nano / 1e9
+            return rub
 
     return 0.0
 
 def get_account_balance() -> float:
-    with sqlite3.connect(DB_PATH) as conn:
+    with _LOCK, _connect() as conn:
         row = conn.execute("SELECT capital FROM account_balance ORDER BY updated_at DESC LIMIT 1").fetchone()
     return row[0] if row else 0.0
\ No newline at end of file
@@ -0,0 +1,363 @@
+"""
+Общие вычислительные ядра бэктестов (Numba).
+
+Ядра принимают только numpy-массивы и скаляры, поэтому pandas участвует
+лишь в подготовке данных, а сам проход по свечам компилируется в машинный код.
+"""
+import threading
+
+import numpy as np
+import pandas as pd
+
+try:
+    import numba
+    from numba import njit, prange
+except ImportError:  # без Numba те же ядра работают как обычный Python — медленно, но верно
+    numba = None
+    prange = range
+
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda fn: fn
+
+# Параллельные ядра Numba (слой workqueue) нельзя запускать одновременно из
+# нескольких потоков — а боты работают потоками в одном процессе.
+_PARALLEL_LOCK = threading.Lock()
+
+MAX_THREADS = numba.config.NUMBA_NUM_THREADS if numba else 1
+
+
+def set_threads(n: int) -> None:
+    """Число потоков параллельных ядер в этом процессе."""
+    if numba is not None:
+        numba.set_num_threads(n)
+
+# ─── СКОЛЬЗЯЩИЕ ОКНА ──────────────────────────────────────────────────────────
+@njit(cache=True)
+def rolling_max(x, window):
+    """Скользящий максимум за O(n): монотонная очередь индексов на массиве."""
+    n = x.shape[0]
+    out = np.full(n, np.nan)
+    dq = np.empty(n, np.int64)
+    head = tail = 0
+    for i in range(n):
+        while tail > head and x[dq[tail - 1]] <= x[i]:
+            tail -= 1
+        dq[tail] = i
+        tail += 1
+        if dq[head] <= i - window:
+            head += 1
+        if i >= window - 1:
+            out[i] = x[dq[head]]
+    return out
+
+
+@njit(cache=True)
+def rolling_mean(x, window):
+    """Скользящее среднее на бегущей сумме (для целых объёмов сумма точна)."""
+    n = x.shape[0]
+    out = np.full(n, np.nan)
+    acc = 0.0
+    for i in range(n):
+        acc += x[i]
+        if i >= window:
+            acc -= x[i - window]
+        if i >= window - 1:
+            out[i] = acc / window
+    return out
+
+
+def _shift1(x: np.ndarray) -> np.ndarray:
+    out = np.empty_like(x)
+    out[:1] = np.nan
+    out[1:] = x[:-1]
+    return out
+
+
+# ─── ЦЕНЫ В ФИКСИРОВАННОЙ ТОЧКЕ ───────────────────────────────────────────────
+# Quotation точна до 1e-9, поэтому цена хранится как int64 нано-единиц
+# (units * 1e9 + nano), а барьеры TP/SL сравниваются точно в целых.
+NANO = 1_000_000_000
+
+
+@njit(cache=True)
+def to_nano(x):
+    """float-цены → int64 нано-единиц (обратимо для цен до ~9e6)."""
+    return np.rint(x * NANO).astype(np.int64)
+
+
+@njit(cache=True)
+def _ceil_frac(q, ppb):
+    """ceil(q * ppb / 1e9) без переполнения int64."""
+    return (q // NANO) * ppb + -(-(q % NANO) * ppb // NANO)
+
+
+def exit_barriers(entry_px: float, tp: float, sl: float) -> tuple[int, int]:
+    """
+    Барьеры TP/SL позиции в нано-единицах — те же, что в breakout_trades:
+    выход по TP при close_q >= tp_q, по SL при close_q <= sl_q.
+    """
+    e = int(np.rint(entry_px * NANO))
+    return e + _ceil_frac(e, round(tp * NANO)), e - _ceil_frac(e, round(sl * NANO))
+
+
+# ─── VOLUME BREAKOUT ──────────────────────────────────────────────────────────
+def breakout_levels(df: pd.DataFrame, lookback: int) -> tuple[np.ndarray, np.ndarray]:
+    """Уровень пробоя и средний объём за `lookback` предыдущих свечей."""
+    hi_lvl = rolling_max(df["high"].to_numpy(np.float64), lookback)
+    vol_ma = rolling_mean(df["vol"].to_numpy(np.float64), lookback)
+    return _shift1(hi_lvl), _shift1(vol_ma)
+
+
+@njit(parallel=True, cache=True)
+def _levels_by_lb(high, vol, lookbacks):
+    n = high.shape[0]
+    hi_by_lb = np.full((lookbacks.shape[0], n), np.nan)
+    vol_ma_by_lb = np.full((lookbacks.shape[0], n), np.nan)
+    if n > 1:
+        for j in prange(lookbacks.shape[0]):
+            # Окно по свечам [..i-1] пишется сразу в позицию i: сдвиг без копии.
+            hi_by_lb[j, 1:] = rolling_max(high[:-1], lookbacks[j])
+            vol_ma_by_lb[j, 1:] = rolling_mean(vol[:-1], lookbacks[j])
+    return hi_by_lb, vol_ma_by_lb
+
+
+@njit(cache=True)
+def breakout_entries(close, hi_lvl, vol, vol_ma, delta):
+    """Индексы свечей с сигналом пробоя (NaN-уровни сравниваются как False)."""
+    sig = (close > hi_lvl) & ((close - hi_lvl) / hi_lvl >= delta) & (vol > vol_ma)
+    return np.flatnonzero(sig)
+
+
+@njit(cache=True)
+def breakout_trades(close, close_q, entries, tp, sl, cap0, risk_pct, commission):
+    """
+    Проход только по сигнальным свечам: вход → поиск первой свечи выхода по
+    TP/SL → следующий сигнал не раньше свечи выхода (выход и вход на одной
+    свече допускаются, как в исходном цикле).
+    """
+    n = close.shape[0]
+    tp_ppb = round(tp * NANO)
+    sl_ppb = round(sl * NANO)
+    cap = cap0
+    trades = wins = losses = 0
+
+    k = 0
+    while k < entries.shape[0]:
+        i = entries[k]
+        k += 1
+        c = close[i]
+        qty = min(int(cap * risk_pct / (c * sl)), int(cap / c))  # усечение = floor для x >= 0
+        if qty <= 0:
+            continue
+        entry_val = qty * c
+        cap -= entry_val * commission
+
+        e = close_q[i]
+        tp_q = e + _ceil_frac(e, tp_ppb)   # close / entry - 1 >= tp
+        sl_q = e - _ceil_frac(e, sl_ppb)   # close / entry - 1 <= -sl
+        # Сравнение с константами через `|` без short-circuit: цикл остаётся
+        # одним базовым блоком без непредсказуемых ветвлений.
+        j = i + 1
+        while j < n and not ((close_q[j] >= tp_q) | (close_q[j] <= sl_q)):
+            j += 1
+        if j == n:
+            break  # позиция открыта до конца истории
+
+        hit_tp = close_q[j] >= tp_q
+        x = close[j]
+        cap += (x * qty - entry_val) - x * qty * commission
+        wins += hit_tp
+        losses += not hit_tp
+        trades += 1
+        k = np.searchsorted(entries, j)
+
+    return (cap / cap0 - 1) * 100, trades, wins, losses
+
+
+@njit(cache=True)
+def breakout_backtest(close, hi_lvl, vol, vol_ma, tp, sl, delta,
+                      cap0, risk_pct, commission):
+    entries = breakout_entries(close, hi_lvl, vol, vol_ma, delta)
+    return breakout_trades(close, to_nano(close), entries, tp, sl,
+                           cap0, risk_pct, commission)
+
+
+def breakout_signals(close: np.ndarray, vol: np.ndarray, hi_by_lb: np.ndarray,
+                     vol_ma_by_lb: np.ndarray, deltas: np.ndarray) -> np.ndarray:
+    """
+    Тензор сигналов S[lb, delta, bar] одним broadcast-выражением: сигнал
+    зависит только от (lookback, delta) и переиспользуется всеми (tp, sl).
+    """
+    rel = (close - hi_by_lb) / hi_by_lb
+    return (((close > hi_by_lb) & (vol > vol_ma_by_lb))[:, None, :]
+            & (rel[:, None, :] >= deltas[None, :, None]))
+
+
+@njit(parallel=True, cache=True)
+def _breakout_grid(close, close_q, entries, ptr, sig_idx, tps, sls,
+                   cap0, risk_pct, commission):
+    out = np.empty((sig_idx.shape[0], 4))
+    for k in prange(sig_idx.shape[0]):
+        g = sig_idx[k]
+        ret, trades, wins, losses = breakout_trades(
+            close, close_q, entries[ptr[g]:ptr[g + 1]], tps[k], sls[k],
+            cap0, risk_pct, commission,
+        )
+        out[k, 0] = ret
+        out[k, 1] = trades
+        out[k, 2] = wins
+        out[k, 3] = losses
+    return out
+
+
+def breakout_grid_search(df: pd.DataFrame, grid: list[tuple[int, float, float, float]],
+                         cap0: float, risk_pct: float, commission: float) -> np.ndarray:
+    """
+    Прогоняет все комбинации (lookback, delta, tp, sl) параллельно по ядрам.
+    Возвращает массив (len(grid), 4): pnl_pct, trades, wins, losses.
+    """
+    lookbacks = sorted({lb for lb, *_ in grid})
+    close = df["close"].to_numpy(np.float64)
+    vol = df["vol"].to_numpy(np.float64)
+    with _PARALLEL_LOCK:
+        # Все окна всех lookback — один параллельный проход вместо цикла по lb
+        hi_by_lb, vol_ma_by_lb = _levels_by_lb(
+            df["high"].to_numpy(np.float64), vol, np.array(lookbacks, dtype=np.int64),
+        )
+
+    params = np.array([(lookbacks.index(lb), d, tp, sl) for lb, d, tp, sl in grid])
+    deltas = np.unique(params[:, 1])
+    sig = breakout_signals(close, vol, hi_by_lb, vol_ma_by_lb, deltas)
+
+    # Индексы сигнальных свечей всех (lb, delta) подряд + смещения начала каждой пары
+    n_sig = len(lookbacks) * len(deltas)
+    pair, entries = np.nonzero(sig.reshape(n_sig, -1))
+    ptr = np.searchsorted(pair, np.arange(n_sig + 1))
+    sig_idx = params[:, 0].astype(np.int64) * len(deltas) + np.searchsorted(deltas, params[:, 1])
+
+    with _PARALLEL_LOCK:
+        return _breakout_grid(
+            close, to_nano(close), entries, ptr, sig_idx, params[:, 2], params[:, 3],
+            float(cap0), float(risk_pct), float(commission),  # int-капитал — иначе новая сигнатура и JIT
+        )
+
+
+# ─── VOLUME SPIKE REVERSAL ────────────────────────────────────────────────────
+def spike_vol_ma(df: pd.DataFrame, window: int = 20) -> np.ndarray:
+    """Средний объём за `window` предыдущих свечей."""
+    return _shift1(rolling_mean(df["vol"].to_numpy(np.float64), window))
+
+
+@njit(cache=True)
+def spike_entries(open_, low, close, vol, vol_ma, mult):
+    """
+    Индексы свечей входа: всплеск объёма и длинный нижний хвост на
+    предыдущей свече, вход — на следующей.
+    """
+    sig = (vol > vol_ma * mult) & (close - low > np.abs(close - open_) * 1.2)
+    return np.flatnonzero(sig[:-1]) + 1
+
+
+@njit(cache=True)
+def spike_trades(close, entries, tp, sl, cap0, risk_pct, commission):
+    """
+    Автомат исходного цикла, но без прохода по свечам вне позиции: без позиции
+    сразу переходим к следующему входу. Сигнал в позиции перезаписывает её,
+    как и раньше.
+    """
+    n = close.shape[0]
+    m = entries.shape[0]
+    cap = cap0
+    trades = wins = losses = 0
+    pos_qty = 0
+    entry_px = entry_val = 0.0
+
+    k = j = 0
+    while True:
+        if pos_qty == 0:
+            if k == m:
+                break
+            j = entries[k]
+        c = close[j]
+        if k < m and entries[k] == j:
+            k += 1
+            qty = int(cap * risk_pct / (c * sl))  # усечение = floor для x >= 0
+            if qty > 0:
+                entry_px = c
+                entry_val = qty * c
+                cap -= entry_val * commission
+                pos_qty = qty
+
+        if pos_qty:
+            change = c / entry_px - 1
+            if change >= tp or change <= -sl:
+                cap += (c * pos_qty - entry_val) - c * pos_qty * commission
+                wins += change >= tp
+                losses += change <= -sl
+                trades += 1
+                pos_qty = 0
+
+        j += 1
+        if j == n:
+            break
+
+    return (cap / cap0 - 1) * 100, trades, wins, losses
+
+
+@njit(cache=True)
+def spike_backtest(open_, low, close, vol, vol_ma, tp, sl, mult,
+                   cap0, risk_pct, commission):
+    entries = spike_entries(open_, low, close, vol, vol_ma, mult)
+    return spike_trades(close, entries, tp, sl, cap0, risk_pct, commission)
+
+
+@njit(parallel=True, cache=True)
+def _spike_grid(close, entries, tps, sls, cap0, risk_pct, commission):
+    out = np.empty((tps.shape[0], 4))
+    for k in prange(tps.shape[0]):
+        ret, trades, wins, losses = spike_trades(
+            close, entries, tps[k], sls[k], cap0, risk_pct, commission,
+        )
+        out[k, 0] = ret
+        out[k, 1] = trades
+        out[k, 2] = wins
+        out[k, 3] = losses
+    return out
+
+
+def spike_grid_search(df: pd.DataFrame, grid: list[tuple[float, float]], mult: float,
+                      cap0: float, risk_pct: float, commission: float) -> np.ndarray:
+    """
+    Прогоняет все пары (tp, sl) параллельно по ядрам; входы от них не
+    зависят и считаются один раз. Возвращает массив (len(grid), 4):
+    pnl_pct, trades, wins, losses.
+    """
+    close = df["close"].to_numpy(np.float64)
+    entries = spike_entries(
+        df["open"].to_numpy(np.float64), df["low"].to_numpy(np.float64),
+        close, df["vol"].to_numpy(np.float64), spike_vol_ma(df), mult,
+    )
+    params = np.array(grid, dtype=np.float64).reshape(-1, 2)
+    with _PARALLEL_LOCK:
+        return _spike_grid(close, entries, params[:, 0], params[:, 1],
+                           float(cap0), float(risk_pct), float(commission))
+
+
+def warmup() -> None:
+    """Компилирует все ядра на крошечных данных (и кладёт их в кэш Numba)."""
+    n = 64
+    x = np.linspace(100.0, 101.0, n)
+    df = pd.DataFrame({"open": x, "high": x, "low": x, "close": x, "vol": np.arange(n, dtype=np.float64)})
+    breakout_grid_search(df, [(10, 0.001, 0.01, 0.01)], 50_000.0, 0.02, 0.0004)
+    hi_lvl, vol_ma = breakout_levels(df, 10)
+    breakout_backtest(x, hi_lvl, df["vol"].to_numpy(), vol_ma, 0.01, 0.01, 0.001, 50_000.0, 0.02, 0.0004)
+    spike_grid_search(df, [(0.01, 0.01)], 2.5, 50_000.0, 0.02, 0.0004)
+    spike_backtest(x, x, x, df["vol"].to_numpy(), spike_vol_ma(df), 0.01, 0.01, 2.5, 50_000.0, 0.02, 0.0004)
+
+
+if __name__ == "__main__":
+    # python backtest_core.py — собрать кэш ядер при установке/деплое, чтобы
+    # первый запуск бота не платил за JIT-компиляцию.
+    warmup()
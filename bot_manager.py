@@ -1,33 +1,39 @@
-from multiprocessing import Process
-from breakout_bot import run_bot
+import threading
+from breakout_bot import BreakoutBot
 from bot_state import get_all_probabilities, init_db
 
-bot_processes = {}
+# Боты работают потоками внутри процесса веб-интерфейса: общий интерпретатор,
+# модули и соединения вместо отдельного процесса на каждый тикер.
+bots: dict[str, tuple[BreakoutBot, threading.Thread]] = {}
+
+STOP_TIMEOUT = 15
 
 def start_bot(ticker: str, live: bool = False):
-    if ticker in bot_processes and bot_processes[ticker].is_alive():
+    if ticker in bots and bots[ticker][1].is_alive():
         return False
-    p = Process(target=run_bot, args=(ticker,), kwargs={"live": live})
-    p.start()
-    bot_processes[ticker] = p
+    bot = BreakoutBot(ticker, live=live)
+    t = threading.Thread(target=bot.start, name=f"bot-{ticker}", daemon=True)
+    t.start()
+    bots[ticker] = (bot, t)
     return True
 
 def stop_bot(ticker: str):
-    if ticker in bot_processes:
-        bot_processes[ticker].terminate()
-        bot_processes[ticker].join()
-        del bot_processes[ticker]
+    if ticker in bots:
+        bot, t = bots.pop(ticker)
+        bot.stop()
+        t.join(STOP_TIMEOUT)
         return True
     return False
 
 def stop_all_bots():
-    for p in bot_processes.values():
-        p.terminate()
-        p.join()
-    bot_processes.clear()
+    for bot, _ in bots.values():
+        bot.stop()
+    for _, t in bots.values():
+        t.join(STOP_TIMEOUT)
+    bots.clear()
 
 def get_status():
-    return {ticker: proc.is_alive() for ticker, proc in bot_processes.items()}
+    return {ticker: t.is_alive() for ticker, (_, t) in bots.items()}
 
 def get_probabilities():
     init_db()
@@ -1,10 +1,29 @@
+import os
 import sqlite3
+import threading
 from pathlib import Path
 
 DB_PATH = Path("bot_state.db")
 
+_LOCK = threading.Lock()
+_conn: sqlite3.Connection | None = None
+_conn_pid: int | None = None
+
+def _connect() -> sqlite3.Connection:
+    # Одно соединение на процесс: проверка pid — для пулов процессов
+    # бэктестов, боты же работают потоками одного процесса и делят
+    # соединение под _LOCK. WAL — чтобы чтение из веб-интерфейса не
+    # блокировало запись ботов.
+    global _conn, _conn_pid
+    if _conn is None or _conn_pid != os.getpid():
+        _conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+        _conn.execute("PRAGMA journal_mode=WAL")
+        _conn.execute("PRAGMA synchronous=NORMAL")
+        _conn_pid = os.getpid()
+    return _conn
+
 def init_db():
-    with sqlite3.connect(DB_PATH) as conn:
+    with _LOCK, _connect() as conn:
         conn.execute("""
         CREATE TABLE IF NOT EXISTS bot_probabilities (
             ticker TEXT PRIMARY KEY,
@@ -14,13 +33,13 @@ def init_db():
         """)
 
 def set_probability(ticker: str, probability: float):
-    with sqlite3.connect(DB_PATH) as conn:
+    with _LOCK, _connect() as conn:
         conn.execute(
             "REPLACE INTO bot_probabilities (ticker, probability, updated_at) VALUES (?, ?, datetime('now'))",
             (ticker.upper(), probability)
         )
 
 def get_all_probabilities() -> dict[str, float]:
-    with sqlite3.connect(DB_PATH) as conn:
+    with _LOCK, _connect() as conn:
         rows = conn.execute("SELECT ticker, probability FROM bot_probabilities").fetchall()
     return {ticker: prob for ticker, prob in rows}
\ No newline at end of file
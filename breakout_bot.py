@@ -70,31 +70,40 @@ from __future__ import annotations
 
 import os
 import sys
+import queue
+import atexit
 import math
 import time
 import random
 import signal
+import itertools
 import logging
+import threading
+from collections import deque
 from datetime import datetime, timedelta, timezone, date
 from zoneinfo import ZoneInfo
 import argparse
 
 import requests
+from requests.adapters import HTTPAdapter
+import numpy as np
 import pandas as pd
 from grpc import StatusCode
 from tinkoff.invest import (
-    Client,
+    CandleInstrument,
     CandleInterval,
-    InstrumentStatus,
     OrderDirection,
     OrderType,
     Quotation,
+    SubscriptionInterval,
 )
 from tinkoff.invest.utils import now
 from tinkoff.invest.exceptions import RequestError
 
+from backtest_core import NANO, breakout_grid_search, exit_barriers
 from bot_state import set_probability
 from account_state import get_account_balance
+from tinkoff_api import candles_frame, get_client, share_figis
 
 # ────────────── Config ─────────────────────────────────────────────────── #
 TICKER = os.getenv("BOT_TICKER", "VTBR").upper()
@@ -109,6 +118,7 @@ TP_GRID = [0.005, 0.01, 0.015]
 SL_GRID = [0.003, 0.005, 0.01]
 DELTA_GRID = [0.001, 0.002, 0.003]
 LOOKBACK_GRID = [10, 20, 30]
+PARAM_GRID = list(itertools.product(LOOKBACK_GRID, DELTA_GRID, TP_GRID, SL_GRID))
 
 INTERVAL = CandleInterval.CANDLE_INTERVAL_1_MIN
 
@@ -117,22 +127,49 @@ TG_TOKEN = os.getenv("TG_BOT_TOKEN")
 TG_CHAT_ID = os.getenv("TG_CHAT_ID")
 
 # ────────────────────────────── Logging ──────────────────────────────────── #
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-)
 log = logging.getLogger("breakout_bot")
 
+
+def setup_logging() -> None:
+    """Настройка логов для точек входа; при импорте модуль её не трогает."""
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+
 # ─────────────────────────── Telegram helper ────────────────────────────── #
-def tg_send(text: str) -> None:
+# Сообщения всех ботов процесса идут через одну очередь: фоновый поток
+# склеивает накопившиеся в пачку (до TG_BATCH_MAX, в пределах лимита длины)
+# и отправляет не чаще TG_RATE_LIMIT сообщений за TG_RATE_PERIOD секунд.
+TG_BATCH_MAX = 20
+TG_MAX_LEN = 4096
+TG_RATE_LIMIT = 20
+TG_RATE_PERIOD = 60.0
+
+_tg_queue: queue.Queue[str] = queue.Queue()
+_tg_session = requests.Session()   # keep-alive: одно TLS-соединение на все отправки
+_tg_session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=2))
+_tg_thread: threading.Thread | None = None
+_tg_thread_lock = threading.Lock()
+
+def tg_send(text: str, ticker: str = "") -> None:
+    global _tg_thread
     if not TG_TOKEN or not TG_CHAT_ID:
         log.debug("TG not configured: %s", text)
         return
-    text = f"*{TICKER}* {text}"
+    if ticker:
+        text = f"*{ticker}* {text}"
+    _tg_queue.put(text)
+    with _tg_thread_lock:
+        if _tg_thread is None or not _tg_thread.is_alive():
+            _tg_thread = threading.Thread(target=_tg_sender, name="tg-sender", daemon=True)
+            _tg_thread.start()
+
+def _tg_post(text: str) -> None:
     url = f"https://api.telegram.org/bot{TG_TOKEN}/sendMessage"
     try:
-        resp = requests.post(
+        resp = _tg_session.post(
             url,
             json={
                 "chat_id": TG_CHAT_ID,
@@ -147,28 +184,64 @@ def tg_send(text: str) -> None:
     except Exception as exc:
         log.exception("Telegram send failed: %s", exc)
 
+def _tg_batches(texts: list[str]) -> list[str]:
+    batches: list[str] = []
+    for text in texts:
+        if batches and len(batches[-1]) + 2 + len(text) <= TG_MAX_LEN:
+            batches[-1] += "\n\n" + text
+        else:
+            batches.append(text)
+    return batches
+
+def _tg_drain(first: str) -> list[str]:
+    texts = [first]
+    while len(texts) < TG_BATCH_MAX:
+        try:
+            texts.append(_tg_queue.get_nowait())
+        except queue.Empty:
+            break
+    return texts
+
+def _tg_sender() -> None:
+    sent: deque[float] = deque()
+    while True:
+        for batch in _tg_batches(_tg_drain(_tg_queue.get())):
+            if len(sent) >= TG_RATE_LIMIT:
+                wait = sent.popleft() + TG_RATE_PERIOD - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+            sent.append(time.monotonic())
+            _tg_post(batch)
+
+@atexit.register
+def _tg_flush() -> None:
+    # Поток-отправитель демонический: досылаем то, что осталось в очереди.
+    texts = []
+    while True:
+        try:
+            texts.append(_tg_queue.get_nowait())
+        except queue.Empty:
+            break
+    for batch in _tg_batches(texts):
+        _tg_post(batch)
+
 # ─────────────────────────── Tinkoff helpers ────────────────────────────── #
 def _qfloat(q: Quotation) -> float:
     return q.units + q.nano / 1e9
 
 def resolve_figi(ticker: str) -> str | None:
-    with Client(TOKEN_INVEST) as c:
-        for inst in c.instruments.shares(instrument_status=InstrumentStatus.INSTRUMENT_STATUS_BASE).instruments:
-            if inst.ticker == ticker and inst.api_trade_available_flag:
-                return inst.figi
-    return None
+    return share_figis().get(ticker)
 
 # ──────────────────────────── Market data ───────────────────────────────── #
-def fetch_candles(figi: str, interval: CandleInterval, days: int) -> pd.DataFrame:
-    since = now() - timedelta(days=days)
-    rows: list[dict] = []
+def fetch_candles(figi: str, interval: CandleInterval, days: int,
+                  since: datetime | None = None) -> pd.DataFrame:
+    since = since or now() - timedelta(days=days)
 
     def _gen():
         backoff, retries = 1, 5
         while True:
             try:
-                with Client(TOKEN_INVEST) as cl:
-                    yield from cl.get_all_candles(figi=figi, from_=since, interval=interval)
+                yield from get_client().get_all_candles(figi=figi, from_=since, interval=interval)
                 break
             except RequestError as e:
                 status, *_ = e.args
@@ -182,31 +255,11 @@ def fetch_candles(figi: str, interval: CandleInterval, days: int) -> pd.DataFram
                 else:
                     raise
 
-    for c in _gen():
-        rows.append({
-            "time": pd.to_datetime(c.time).tz_convert("Europe/Moscow"),
-            "open": _qfloat(c.open),
-            "high": _qfloat(c.high),
-            "low": _qfloat(c.low),
-            "close": _qfloat(c.close),
-            "vol": c.volume,
-        })
-    df = pd.DataFrame(rows).set_index("time").sort_index()
-    return df
-
-def fetch_latest_candle(figi: str) -> dict | None:
-    to_time = now()
-    from_time = to_time - timedelta(minutes=3)
-    with Client(TOKEN_INVEST) as cl:
-        cs = cl.market_data.get_candles(figi=figi, from_=from_time, to=to_time, interval=INTERVAL).candles
-    if not cs:
-        return None
-    c = cs[-1]
-    closed = pd.to_datetime(c.time).tz_convert("Europe/Moscow")
-    if closed >= datetime.now(timezone.utc).astimezone(ZoneInfo("Europe/Moscow")):
-        return None
+    return candles_frame(_gen())
+
+def candle_to_dict(c) -> dict:
     return {
-        "time": closed,
+        "time": pd.to_datetime(c.time).tz_convert("Europe/Moscow"),
         "open": _qfloat(c.open),
         "high": _qfloat(c.high),
         "low": _qfloat(c.low),
@@ -215,79 +268,119 @@ def fetch_latest_candle(figi: str) -> dict | None:
     }
 
 # ────────────────────────── Strategy back-test ──────────────────────────── #
-def backtest(df: pd.DataFrame, lookback: int, delta: float, tp: float, sl: float) -> tuple[float,int,int,int]:
-    df = df.copy()
-    df["hi_lvl"] = df["high"].rolling(lookback).max().shift(1)
-    df["vol_ma"] = df["vol"].rolling(lookback).mean().shift(1)
-    cap = CAPITAL_START
-    pos_qty = entry_px = entry_val = 0.0
-    trades = wins = losses = 0
-    for r in df.itertuples():
-        if pos_qty:
-            change = r.close / entry_px - 1
-            if change >= tp or change <= -sl:
-                cap += (r.close*pos_qty - entry_val) - r.close*pos_qty*COMMISSION
-                wins += change >= tp
-                losses += change <= -sl
-                trades += 1
-                pos_qty = 0
-        if not pos_qty and r.close > r.hi_lvl and (r.close - r.hi_lvl)/r.hi_lvl >= delta and r.vol > r.vol_ma:
-            risk = cap * RISK_PCT
-            qty = min(math.floor(risk/(r.close*sl)), math.floor(cap/r.close))
-            if qty > 0:
-                pos_qty = qty
-                entry_px = r.close
-                entry_val = qty * r.close
-                cap -= entry_val * COMMISSION
-    return (cap/CAPITAL_START - 1)*100, trades, wins, losses
-
 def optimize_params(df: pd.DataFrame) -> dict:
-    best = {"ret": -1e9}
-    for lb in LOOKBACK_GRID:
-        for d in DELTA_GRID:
-            for tp in TP_GRID:
-                for sl in SL_GRID:
-                    ret, tr, w, l = backtest(df, lb, d, tp, sl)
-                    if ret > best["ret"]:
-                        best.update({"ret":ret, "lookback":lb, "delta":d, "tp":tp, "sl":sl, "trades":tr, "wins":w, "losses":l})
-    return best
+    res = breakout_grid_search(df, PARAM_GRID, CAPITAL_START, RISK_PCT, COMMISSION)
+    k = int(np.argmax(res[:, 0]))
+    lb, d, tp, sl = PARAM_GRID[k]
+    tr, w, l = (int(x) for x in res[k, 1:])
+    return {"ret":float(res[k, 0]), "lookback":lb, "delta":d, "tp":tp, "sl":sl, "trades":tr, "wins":w, "losses":l}
+
+# ──────────────────────────── Live levels ───────────────────────────────── #
+class RollingMax:
+    """Максимум последних `window` значений: монотонная очередь, O(1) амортизированно."""
+
+    def __init__(self, window: int):
+        self.window = window
+        self.count = 0
+        self._dq: deque[tuple[float, int]] = deque()
+
+    def push(self, x: float) -> None:
+        while self._dq and self._dq[-1][0] <= x:
+            self._dq.pop()
+        self._dq.append((x, self.count))
+        self.count += 1
+        if self._dq[0][1] < self.count - self.window:
+            self._dq.popleft()
+
+    @property
+    def value(self) -> float:
+        return self._dq[0][0] if self.count >= self.window else math.nan
+
+class RollingMean:
+    """Среднее последних `window` значений на бегущей сумме, O(1)."""
+
+    def __init__(self, window: int):
+        self.window = window
+        self._buf: deque[float] = deque()
+        self._sum = 0.0
+
+    def push(self, x: float) -> None:
+        self._buf.append(x)
+        self._sum += x
+        if len(self._buf) > self.window:
+            self._sum -= self._buf.popleft()
+
+    @property
+    def value(self) -> float:
+        return self._sum / self.window if len(self._buf) >= self.window else math.nan
 
 # ───────────────────────────── Bot class ───────────────────────────────── #
 class BreakoutBot:
-    def __init__(self, figi: str):
-        self.figi = figi
+    def __init__(self, ticker: str, days_back: int = DAYS_BACK, live: bool = LIVE_TRADING):
+        self.ticker = ticker.upper()
+        self.days_back = days_back
+        self.live = live
+        self.figi: str | None = None
         self.df: pd.DataFrame = pd.DataFrame()
         self.best: dict | None = None
+        self.hi_max: RollingMax | None = None
+        self.vol_ma: RollingMean | None = None
         self.day: date | None = None
         self.capital = get_account_balance()
         self.pos_qty = 0
         self.entry_px = self.entry_val = 0.0
         self.running = True
+        self.stream = None
 
     def start(self):
-        signal.signal(signal.SIGINT, self._stop)
-        signal.signal(signal.SIGTERM, self._stop)
-        tg_send(f"\ud83d\ude80 Breakout bot started (live: `{LIVE_TRADING}`)")
+        self.figi = resolve_figi(self.ticker)
+        if not self.figi:
+            log.error("Не удалось получить FIGI для тикера %s", self.ticker)
+            return
+
+        self._tg(f"\ud83d\ude80 Breakout bot started (live: `{self.live}`)")
 
         self.day = datetime.now(timezone.utc).astimezone(ZoneInfo("Europe/Moscow")).date()
         self._refresh_history()
 
         while self.running:
             try:
-                self._maybe_new_day()
-                candle = fetch_latest_candle(self.figi)
-                if candle:
-                    self._process_candle(candle)
-                self.capital = get_account_balance()
-                time.sleep(60)
+                self._stream_candles()
             except Exception as exc:
-                log.exception("Unhandled error: %s", exc)
-                tg_send(f"\u2757\ufe0f Unhandled error: `{exc}`")
+                log.exception("[%s] Unhandled error: %s", self.ticker, exc)
+                self._tg(f"\u2757\ufe0f Unhandled error: `{exc}`")
                 time.sleep(10)
 
-    def _stop(self, *_):
+    def _stream_candles(self):
+        # Сервер присылает обновления текущей минутной свечи; свеча закрыта,
+        # когда приходит первая сделка следующей минуты.
+        self.stream = get_client().create_market_data_stream()
+        self.stream.candles.subscribe([
+            CandleInstrument(figi=self.figi, interval=SubscriptionInterval.SUBSCRIPTION_INTERVAL_ONE_MINUTE)
+        ])
+        if not self.running:
+            self.stream.stop()
+        pending = None
+        for md in self.stream:
+            if not self.running:
+                break
+            c = md.candle
+            if not c:
+                continue
+            if pending is not None and c.time > pending.time:
+                self._process_candle(candle_to_dict(pending))
+                self._maybe_new_day()
+                self.capital = get_account_balance()
+            pending = c
+
+    def stop(self, *_):
         self.running = False
-        tg_send("\u23f9 Bot stopped")
+        if self.stream is not None:
+            self.stream.stop()
+        self._tg("\u23f9 Bot stopped")
+
+    def _tg(self, text: str) -> None:
+        tg_send(text, self.ticker)
 
     def _maybe_new_day(self):
         today = datetime.now(timezone.utc).astimezone(ZoneInfo("Europe/Moscow")).date()
@@ -296,23 +389,49 @@ class BreakoutBot:
             self._refresh_history()
 
     def _refresh_history(self):
-        log.info("Fetching history...")
-        self.df = fetch_candles(self.figi, INTERVAL, DAYS_BACK)
+        if self.df.empty:
+            log.info("[%s] Fetching history...", self.ticker)
+            self.df = fetch_candles(self.figi, INTERVAL, self.days_back)
+        else:
+            # История уже в памяти: докачиваем только свечи после последней
+            # и отрезаем то, что вышло за окно days_back.
+            last = self.df.index[-1].to_pydatetime()
+            log.info("[%s] Fetching candles since %s...", self.ticker, last)
+            df = pd.concat([self.df, fetch_candles(self.figi, INTERVAL, self.days_back, since=last)])
+            df = df[~df.index.duplicated(keep="last")].sort_index()
+            self.df = df[df.index >= now() - timedelta(days=self.days_back)]
         self.best = optimize_params(self.df)
+        # Окна заполняются при первой следующей свече: история уже содержит
+        # её незакрытую версию (и, при дневном пересчёте, более поздние).
+        self.hi_max = self.vol_ma = None
         msg = (
             "\ud83d\udd0d Best params for last *{}* days:\n"
             "lookback = `{lookback}`, delta = `{delta}`, tp = `{tp}`, sl = `{sl}`\n"
             "PnL = `{ret:.2f}%`, trades = `{trades}` (win {wins} / loss {losses})"
-        ).format(DAYS_BACK, **self.best)
-        tg_send(msg)
-        log.info(msg.replace("\n", " "))
+        ).format(self.days_back, **self.best)
+        self._tg(msg)
+        log.info("[%s] %s", self.ticker, msg.replace("\n", " "))
 
-    def _process_candle(self, c: dict):
-        ts = c["time"]
-        self.df.loc[ts] = [c[k] for k in ["open","high","low","close","vol"]]
+    def _seed_levels(self, ts: pd.Timestamp):
+        """Окна уровней из lb последних свечей истории строго раньше `ts`."""
         lb = self.best["lookback"]
-        hi_lvl = self.df["high"].rolling(lb).max().shift(1).iat[-1]
-        vol_ma = self.df["vol"].rolling(lb).mean().shift(1).iat[-1]
+        hist = self.df[self.df.index < ts].iloc[-lb:]
+        self.hi_max = RollingMax(lb)
+        self.vol_ma = RollingMean(lb)
+        for h, v in zip(hist["high"].to_numpy(), hist["vol"].to_numpy()):
+            self.hi_max.push(h)
+            self.vol_ma.push(v)
+
+    def _process_candle(self, c: dict):
+        # Уровни — по предыдущим lb свечам, затем окна сдвигаются на текущую.
+        # self.df между пересчётами не растёт: живые свечи докачиваются
+        # из истории при следующем _refresh_history.
+        if self.hi_max is None:
+            self._seed_levels(c["time"])
+        hi_lvl = self.hi_max.value
+        vol_ma = self.vol_ma.value
+        self.hi_max.push(c["high"])
+        self.vol_ma.push(c["vol"])
         close, vol = c["close"], c["vol"]
 
         # Расчёт вероятности пробоя
@@ -321,18 +440,20 @@ class BreakoutBot:
         volume_progress = vol / vol_ma if vol_ma else 0
         prob_index = (min(price_progress, 1.0) + min(volume_progress, 1.0)) / 2
         prob_pct = prob_index * 100
-        set_probability(TICKER, prob_pct)
+        set_probability(self.ticker, prob_pct)
 
         if self.pos_qty:
-            change = close / self.entry_px - 1
-            if change >= self.best["tp"] or change <= -self.best["sl"]:
+            # Барьеры в нано-единицах, как в бэктесте: ровно tp/sl — уже выход.
+            tp_q, sl_q = exit_barriers(self.entry_px, self.best["tp"], self.best["sl"])
+            close_q = int(np.rint(close * NANO))
+            if close_q >= tp_q or close_q <= sl_q:
                 proceeds = close * self.pos_qty
                 pnl_gross = proceeds - self.entry_val
                 pnl_net = pnl_gross - proceeds * COMMISSION
                 self.capital += pnl_net
-                res = "\u2705 TP hit" if change >= self.best["tp"] else "\ud83d\udea9 SL hit"
+                res = "\u2705 TP hit" if close_q >= tp_q else "\ud83d\udea9 SL hit"
                 word = "прибыль" if pnl_net >= 0 else "убыток"
-                tg_send(f"{res} @ `{close}` {word} `{pnl_net:.2f}` equity `{self.capital:.2f}`")
+                self._tg(f"{res} @ `{close}` {word} `{pnl_net:.2f}` equity `{self.capital:.2f}`")
                 self._close_position()
                 return
 
@@ -341,7 +462,7 @@ class BreakoutBot:
             (close - hi_lvl)/hi_lvl >= self.best["delta"] and
             vol > vol_ma):
             risk = self.capital * RISK_PCT
-            qty = math.floor(risk / (close * self.best["sl"]))
+            qty = int(risk / (close * self.best["sl"]))
             if qty > 0:
                 self._open_position(qty, close)
 
@@ -350,50 +471,41 @@ class BreakoutBot:
         self.entry_px = price
         self.entry_val = qty * price
         cost = self.entry_val * (1 + COMMISSION)
-        tg_send(f"\ud83d\udcc8 Buy {qty} @ `{price}` cost `{cost:.2f}` (live={LIVE_TRADING})")
-        if LIVE_TRADING:
+        self._tg(f"\ud83d\udcc8 Buy {qty} @ `{price}` cost `{cost:.2f}` (live={self.live})")
+        if self.live:
             self._place_market_order(qty, OrderDirection.ORDER_DIRECTION_BUY)
 
     def _close_position(self):
-        if self.pos_qty and LIVE_TRADING:
+        if self.pos_qty and self.live:
             self._place_market_order(self.pos_qty, OrderDirection.ORDER_DIRECTION_SELL)
         self.pos_qty = 0
 
     def _place_market_order(self, qty: int, direction: OrderDirection):
         try:
-            with Client(TOKEN_INVEST) as cl:
-                order_id = f"bot-{int(time.time()*1e6)}"
-                cl.orders.post_order(
-                    figi=self.figi,
-                    quantity=qty,
-                    order_type=OrderType.ORDER_TYPE_MARKET,
-                    direction=direction,
-                    account_id=cl.users.get_accounts().accounts[0].id,
-                    order_id=order_id,
-                )
-                tg_send(f"\ud83d\udcb8 Order {order_id} executed: {direction.name} {qty}")
+            cl = get_client()
+            order_id = f"bot-{int(time.time()*1e6)}"
+            cl.orders.post_order(
+                figi=self.figi,
+                quantity=qty,
+                order_type=OrderType.ORDER_TYPE_MARKET,
+                direction=direction,
+                account_id=cl.users.get_accounts().accounts[0].id,
+                order_id=order_id,
+            )
+            self._tg(f"\ud83d\udcb8 Order {order_id} executed: {direction.name} {qty}")
         except Exception as exc:
-            log.exception("Order failed: %s", exc)
-            tg_send(f"\u26a0\ufe0f Order failed: `{exc}`")
+            log.exception("[%s] Order failed: %s", self.ticker, exc)
+            self._tg(f"\u26a0\ufe0f Order failed: `{exc}`")
 
 # ─────────────────────────────── run_bot ────────────────────────────────── #
 def run_bot(ticker: str, days_back: int = 30, live: bool = False):
-    global TICKER, DAYS_BACK, LIVE_TRADING, FIGI
-
-    TICKER = ticker.upper()
-    DAYS_BACK = days_back
-    LIVE_TRADING = live
-
     if TOKEN_INVEST is None:
         raise SystemExit("TINKOFF_TOKEN not set")
 
-    FIGI = resolve_figi(TICKER)
-    if not FIGI:
-        print(f"[run_bot] Не удалось получить FIGI для тикера {TICKER}")
-        return
-
-    log.info("Запуск run_bot для %s (live=%s)", TICKER, LIVE_TRADING)
-    bot = BreakoutBot(FIGI)
+    log.info("Запуск run_bot для %s (live=%s)", ticker.upper(), live)
+    bot = BreakoutBot(ticker, days_back=days_back, live=live)
+    signal.signal(signal.SIGINT, bot.stop)
+    signal.signal(signal.SIGTERM, bot.stop)
     bot.start()
 
 # ─────────────────────────────── main ───────────────────────────────────── #
@@ -404,4 +516,5 @@ if __name__ == "__main__":
     parser.add_argument("--live", action="store_true", help="Enable live trading")
     args = parser.parse_args()
 
+    setup_logging()
     run_bot(args.ticker, days_back=args.days_back, live=args.live)
@@ -0,0 +1,49 @@
+"""
+Дисковый кэш минутных свечей для бэктестов.
+
+Повторный прогон сетки в течение CANDLE_CACHE_TTL не ходит в API вовсе,
+а устаревший кэш докачивается только от последней сохранённой свечи.
+Каталог — CANDLE_CACHE_DIR (по умолчанию ~/.cache/ecopark/candles).
+"""
+import os
+import time
+from collections.abc import Callable
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pandas as pd
+from tinkoff.invest.utils import now
+
+CANDLE_CACHE_DIR = Path(os.getenv("CANDLE_CACHE_DIR", "~/.cache/ecopark/candles")).expanduser()
+CANDLE_CACHE_TTL = 3600   # сек
+
+
+def cached_candles(key: str, days: int, fetch: Callable[[datetime | None], pd.DataFrame]) -> pd.DataFrame:
+    """
+    Свечи за последние `days` дней по ключу `key`.
+    `fetch(since)` качает свечи начиная с `since` (None — за все `days` дней).
+    """
+    path = CANDLE_CACHE_DIR / f"{key}.pkl"
+    start = now() - timedelta(days=days)
+
+    try:
+        df = pd.read_pickle(path)
+    except Exception:
+        # Нет файла, он битый или несовместим после обновления pandas —
+        # промах: ниже кэш перезапишется свежей загрузкой.
+        df = None
+
+    if df is not None and time.time() - path.stat().st_mtime < CANDLE_CACHE_TTL:
+        return df[df.index >= start]
+    if df is not None and not df.empty:
+        df = pd.concat([df, fetch(df.index[-1].to_pydatetime())])
+        df = df[~df.index.duplicated(keep="last")].sort_index()
+    else:
+        df = fetch(None)
+
+    df = df[df.index >= start]
+    CANDLE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    df.to_pickle(tmp)
+    os.replace(tmp, path)
+    return df
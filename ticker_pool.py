@@ -0,0 +1,60 @@
+"""
+Пул процессов для бэктестов по тикерам.
+
+Тикеры считаются в ProcessPoolExecutor, начала загрузок свечей из всех
+процессов разносятся не чаще API_MIN_INTERVAL через общий
+multiprocessing.Value, а потоки параллельных ядер Numba делятся между
+процессами. Сами запросы внутри загрузки (get_all_candles — примерно по
+запросу на день истории) не троттлятся: лимит API ловит RESOURCE_EXHAUSTED
+с ожиданием ratelimit_reset в fetch_candles.
+"""
+import multiprocessing
+import time
+from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from backtest_core import MAX_THREADS, set_threads
+from tinkoff_api import close_client
+
+WORKERS          = 4    # процессов для параллельного бэктеста тикеров
+API_MIN_INTERVAL = 0.5  # сек между началами загрузок свечей со всех процессов
+
+_api_next_call = None   # multiprocessing.Value: время следующего разрешённого начала загрузки
+
+
+def _init_worker(next_call, numba_threads):
+    global _api_next_call
+    _api_next_call = next_call
+    # Ядра сетки параллельны сами по себе: делим потоки Numba между
+    # процессами пула, а не запускаем по потоку на ядро в каждом.
+    set_threads(numba_threads)
+
+
+def throttle_api():
+    """Разносит начала загрузок всех процессов пула не чаще API_MIN_INTERVAL."""
+    if _api_next_call is None:
+        return
+    with _api_next_call.get_lock():
+        now_ts = time.time()
+        slot = max(_api_next_call.value, now_ts)
+        _api_next_call.value = slot + API_MIN_INTERVAL
+    if slot > now_ts:
+        time.sleep(slot - now_ts)
+
+
+def run_tickers(process_ticker: Callable[[str, str], dict | None],
+                figi_map: dict[str, str], workers: int = WORKERS) -> list[dict]:
+    """`process_ticker(ticker, figi)` по всем тикерам в пуле; None-результаты отбрасываются."""
+    close_client()  # gRPC-канал не переживает fork: воркеры откроют свои
+
+    results = []
+    next_call = multiprocessing.Value("d", 0.0)
+    numba_threads = max(1, MAX_THREADS // workers)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(next_call, numba_threads)) as pool:
+        futures = [pool.submit(process_ticker, ticker, figi) for ticker, figi in figi_map.items()]
+        for fut in as_completed(futures):
+            res = fut.result()
+            if res:
+                results.append(res)
+    return results
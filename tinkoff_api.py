@@ -0,0 +1,104 @@
+"""
+Общий клиент Tinkoff Invest API и разбор свечей.
+
+Один gRPC-канал на процесс вместо `with Client(...)` на каждый вызов:
+HTTP/2-канал рассчитан на переиспользование, а каждое новое подключение —
+это TLS-рукопожатие и лишний RTT. Канал потокобезопасен, поэтому его делят
+все боты процесса. После fork дочерний процесс открывает свой канал.
+"""
+import atexit
+import os
+import threading
+from array import array
+from collections.abc import Iterable
+
+import numpy as np
+import pandas as pd
+from tinkoff.invest import Client, HistoricCandle, InstrumentStatus
+from tinkoff.invest.services import Services
+
+FIGI_CACHE_TTL = 24 * 3600   # сек, список акций меняется редко
+
+_LOCK = threading.Lock()
+_client_cm: Client | None = None
+_client: Services | None = None
+_client_pid: int | None = None
+
+
+def get_client() -> Services:
+    global _client_cm, _client, _client_pid
+    with _LOCK:
+        if _client is None or _client_pid != os.getpid():
+            token = os.getenv("TINKOFF_TOKEN")
+            if not token:
+                raise RuntimeError("TINKOFF_TOKEN not set")
+            _client_cm = Client(token)
+            _client = _client_cm.__enter__()
+            _client_pid = os.getpid()
+        return _client
+
+
+def close_client() -> None:
+    """Закрывает канал; следующий get_client() откроет новый."""
+    global _client_cm, _client, _client_pid
+    with _LOCK:
+        if _client_cm is not None and _client_pid == os.getpid():
+            _client_cm.__exit__(None, None, None)
+        _client_cm = _client = _client_pid = None
+
+
+atexit.register(close_client)
+
+
+def share_figis(currency: str | None = None) -> dict[str, str]:
+    """
+    Торгуемые через API акции: тикер → FIGI, при `currency` — только в этой
+    валюте. Список берётся из figi_cache в account_state.db и перекачивается
+    из shares() не чаще раза в FIGI_CACHE_TTL.
+    """
+    from account_state import load_figi_cache, save_figi_cache  # account_state импортирует этот модуль
+
+    rows = load_figi_cache(FIGI_CACHE_TTL)
+    if not rows:
+        rows = [
+            (inst.ticker, inst.figi, inst.currency.lower())
+            for inst in get_client().instruments.shares(instrument_status=InstrumentStatus.INSTRUMENT_STATUS_BASE).instruments
+            if inst.api_trade_available_flag
+        ]
+        save_figi_cache(rows)
+    figis = {}
+    for ticker, figi, cur in rows:
+        if currency is None or cur == currency.lower():
+            figis.setdefault(ticker, figi)  # при повторе тикера — первое совпадение
+    return figis
+
+
+def candles_frame(candles: Iterable[HistoricCandle],
+                  cols: tuple[str, ...] = ("open", "high", "low", "close")) -> pd.DataFrame:
+    """
+    Свечи → DataFrame с ценами `cols` во float, объёмом `vol` и индексом
+    времени по Москве. Поля копятся в типизированные array без промежуточных
+    словарей, время переводится в индекс одним вызовом.
+    """
+    times = []
+    units = {col: array("q") for col in cols}
+    nanos = {col: array("i") for col in cols}
+    vols = array("q")
+    for c in candles:
+        times.append(c.time)
+        for col in cols:
+            q = getattr(c, col)
+            units[col].append(q.units)
+            nanos[col].append(q.nano)
+        vols.append(c.volume)
+
+    index = pd.DatetimeIndex(pd.to_datetime(times, utc=True), name="time")
+    df = pd.DataFrame(
+        {
+            **{col: np.frombuffer(units[col], np.int64) + np.frombuffer(nanos[col], np.int32) / 1e9
+               for col in cols},
+            "vol": np.array(vols, dtype=np.int64),
+        },
+        index=index.tz_convert("Europe/Moscow"),
+    )
+    return df.sort_index()
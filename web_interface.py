@@ -1,7 +1,9 @@
 from flask import Flask, render_template, request, redirect, url_for
 from bot_manager import start_bot, stop_bot, stop_all_bots, get_status, get_probabilities
+from breakout_bot import setup_logging
 from bot_state import init_db
 from account_state import init_account_db, update_account_balance, get_account_balance
+import functools
 import threading
 import time
 import pandas as pd
@@ -10,13 +12,25 @@ import glob
 
 app = Flask(__name__)
 
+# Колонки результатов breakout_backtests, которые показывает index.html
+BACKTEST_DTYPES = {
+    "ticker": str, "pnl_pct": "float64", "lookback": "int64", "delta": "float64",
+    "tp": "float64", "sl": "float64", "trades": "int64", "wins": "int64", "losses": "int64",
+}
+
+@functools.lru_cache(maxsize=1)
+def _read_backtest_csv(path: str, mtime: float) -> list[dict]:
+    # Пропусков в файле нет: na_filter=False заодно не даёт тикеру "NA" стать NaN
+    df = pd.read_csv(path, usecols=list(BACKTEST_DTYPES), dtype=BACKTEST_DTYPES, na_filter=False)
+    return df.to_dict(orient="records")
+
 def load_latest_backtest_csv() -> list[dict]:
     files = sorted(glob.glob("backtest_results_*.csv"), reverse=True)
     if not files:
         return []
     try:
-        df = pd.read_csv(files[0])
-        return df.to_dict(orient="records")
+        # CSV перечитывается, только когда появился новый файл или изменился текущий
+        return list(_read_backtest_csv(files[0], os.path.getmtime(files[0])))
     except Exception as e:
         print(f"❌ Ошибка загрузки CSV: {e}")
         return []
@@ -59,6 +73,7 @@ def balance_updater(interval_sec=5):
         time.sleep(interval_sec)
 
 if __name__ == "__main__":
+    setup_logging()
     init_account_db()
 
     t = threading.Thread(target=balance_updater, daemon=True)